@@ -4,27 +4,47 @@ import struct
 import time
 import os
 import pty
-import threading
-import select
+import selectors
 
 # --- Configuration ---
+RAW_SAMPLING_RATE_HZ = 250.0
 DOWNSAMPLE_RATIO = 2 
+OBCI_BATCH_FRAMES = 5 # Output packets sent to the GUI per write (40 ms at 125 Hz)
+# A batch fills within this time at the board rate, so the timer only flushes
+# a partial batch when the stream stalls (seconds)
+OBCI_FLUSH_INTERVAL = OBCI_BATCH_FRAMES * DOWNSAMPLE_RATIO / RAW_SAMPLING_RATE_HZ
 
 # --- Constants ---
 RAW_START = 0xABCD
 RAW_END = 0xDCBA
 RAW_SIZE = 37 
+RAW_START_BYTES = RAW_START.to_bytes(2, 'big')
+RAW_END_BYTES = RAW_END.to_bytes(2, 'big')
 OBCI_START_BYTE = 0xA0
 OBCI_END_BYTE = 0xC0
+RAW_IDX_EEG = 10 # After the 7 byte header and 3 ADS1299 status bytes
+EEG_DATA_SIZE = 24
+# [0xA0][sample index][24 EEG bytes][6 aux bytes][0xC0]
+OBCI_PACKET_SIZE = 33
+OBCI_IDX_EEG = 2
 
 # --- Hardware Config ---
 INITIAL_BAUD_RATE = 9600
 FINAL_BAUD_RATE = 115200
 FIRMWARE_BAUD_RATE_INDEX = 0x04
+# start(2) | 0x02, unix time | 0x01, baud index | checksum | end(2)
+HANDSHAKE_STRUCT = struct.Struct('>BBBIBBBBB')
+HANDSHAKE_IDX_CHECKSUM = 9
 BOARD_USB_IDS = [{'vid': 0x1A86, 'pid': 0x7523}]
 BOARD_DESCRIPTIONS = ["USB-SERIAL CH340", "CH340"]
+READ_BATCH = max(RAW_SIZE, FINAL_BAUD_RATE // 10 // 10) # Up to 100 ms of line rate per read
+BUFFER_COMPACT_SIZE = 4096 # Drop consumed bytes from the buffer past this size
 
-streaming_enabled = False
+def build_handshake_packet(unix_time):
+    """Handshake that sets the board clock and switches it to FINAL_BAUD_RATE."""
+    packet = bytearray(HANDSHAKE_STRUCT.pack(0xAA, 0xBB, 0x02, unix_time, 0x01, FIRMWARE_BAUD_RATE_INDEX, 0, 0xCC, 0xDD))
+    packet[HANDSHAKE_IDX_CHECKSUM] = sum(packet[2:HANDSHAKE_IDX_CHECKSUM]) & 0xFF
+    return packet
 
 def find_and_open_board():
     print("Searching for Cerelog Board...")
@@ -38,12 +58,9 @@ def find_and_open_board():
         try:
             ser = serial.Serial(port_name, INITIAL_BAUD_RATE, timeout=2)
             time.sleep(3)
-            if ser.in_waiting: ser.read(ser.in_waiting)
+            ser.reset_input_buffer()
 
-            ts = int(time.time())
-            payload = struct.pack('>BI', 0x02, ts) + bytes([0x01, FIRMWARE_BAUD_RATE_INDEX])
-            chk = sum(payload) & 0xFF
-            pkt = struct.pack('>BB', 0xAA, 0xBB) + payload + struct.pack('>B', chk) + struct.pack('>BB', 0xCC, 0xDD)
+            pkt = build_handshake_packet(int(time.time()))
             
             ser.write(pkt)
             time.sleep(0.1)
@@ -59,44 +76,46 @@ def find_and_open_board():
             if ser: ser.close()
     return None
 
-def gui_command_listener(master_fd):
-    global streaming_enabled
-    
-    # === UPDATED IDENTITY STRING ===
-    # Added \r\n to match exact serial terminal behavior
-    ID_STRING = b"OpenBCI V3 8-16 channel\r\nOn Board ADS1299 Device ID: 0x3E\r\n$$$"
-
-    while True:
-        try:
-            r, _, _ = select.select([master_fd], [], [], 0.1)
-            if master_fd in r:
-                cmd_bytes = os.read(master_fd, 1024)
-                for byte in cmd_bytes:
-                    char = chr(byte)
-                    if char == 'v':
-                        print("[GUI] Reset (v) -> Sending ID")
-                        streaming_enabled = False
-                        os.write(master_fd, ID_STRING)
-                    elif char == 'b':
-                        print("[GUI] Start (b)")
-                        streaming_enabled = True
-                    elif char == 's':
-                        print("[GUI] Stop (s)")
-                        streaming_enabled = False
-                    # Acknowledge commands
-                    elif char in 'xX12345678!@#$%^&*()qwertyuiop': 
-                        os.write(master_fd, b',') 
-        except OSError:
-            break
+# === UPDATED IDENTITY STRING ===
+# Added \r\n to match exact serial terminal behavior
+ID_STRING = b"OpenBCI V3 8-16 channel\r\nOn Board ADS1299 Device ID: 0x3E\r\n$$$"
+
+def handle_gui_commands(master_fd, cmd_bytes, streaming_enabled):
+    """Answer GUI commands read from the pty, returns the new streaming state."""
+    for byte in cmd_bytes:
+        char = chr(byte)
+        if char == 'v':
+            print("[GUI] Reset (v) -> Sending ID")
+            streaming_enabled = False
+            os.write(master_fd, ID_STRING)
+        elif char == 'b':
+            print("[GUI] Start (b)")
+            streaming_enabled = True
+        elif char == 's':
+            print("[GUI] Stop (s)")
+            streaming_enabled = False
+        # Acknowledge commands
+        elif char in 'xX12345678!@#$%^&*()qwertyuiop': 
+            os.write(master_fd, b',') 
+    return streaming_enabled
 
 def main():
     ser = find_and_open_board()
     if not ser: return
+    try:
+        # Linux: have the USB-serial driver hand bytes over as they arrive (~16 ms otherwise)
+        ser.set_low_latency_mode(True)
+    except (AttributeError, ValueError):
+        pass
 
     master_fd, slave_fd = pty.openpty()
     virtual_port = os.ttyname(slave_fd)
-    
-    threading.Thread(target=gui_command_listener, args=(master_fd,), daemon=True).start()
+
+    # One loop waits on both the board and the GUI (epoll/kqueue where available)
+    sel = selectors.DefaultSelector()
+    sel.register(ser.fileno(), selectors.EVENT_READ, 'ser')
+    sel.register(master_fd, selectors.EVENT_READ, 'pty')
+    streaming_enabled = False
 
     print("\n" + "="*60)
     print(f"VIRTUAL DONGLE ACTIVE AT: {virtual_port}")
@@ -105,43 +124,69 @@ def main():
     print("="*60 + "\n")
     
     buffer = bytearray()
-    start_marker = RAW_START.to_bytes(2, 'big')
-    end_marker = RAW_END.to_bytes(2, 'big')
+    read_pos = 0
     packet_counter = 0
     sample_index = 0
 
+    # Output packets are staged back to back in one preallocated buffer and
+    # written to the pty together (one syscall per batch)
+    out_frames = bytearray(OBCI_PACKET_SIZE * OBCI_BATCH_FRAMES)
+    for frame in range(0, len(out_frames), OBCI_PACKET_SIZE):
+        out_frames[frame] = OBCI_START_BYTE
+        out_frames[frame + OBCI_PACKET_SIZE - 1] = OBCI_END_BYTE
+    n_pending = 0
+    first_pending_time = 0.0
+
     try:
         while True:
-            if ser.in_waiting:
-                buffer.extend(ser.read(ser.in_waiting))
-            else:
-                time.sleep(0.0001)
+            for key, _ in sel.select(timeout=OBCI_FLUSH_INTERVAL if n_pending else 1.0):
+                if key.data == 'pty':
+                    streaming_enabled = handle_gui_commands(master_fd, os.read(master_fd, 1024), streaming_enabled)
+                    # Stale samples must not follow a stop or the ID string
+                    if not streaming_enabled: n_pending = 0
+                else:
+                    data = os.read(ser.fileno(), READ_BATCH)
+                    if not data:
+                        # Readable but empty means the board was unplugged (pyserial raises the same)
+                        raise serial.SerialException("device reports readiness to read but returned no data (device disconnected?)")
+                    buffer.extend(data)
 
             while True:
-                start_idx = buffer.find(start_marker)
+                start_idx = buffer.find(RAW_START_BYTES, read_pos)
                 if start_idx == -1:
-                    if len(buffer) > 0: buffer = buffer[-1:]
+                    read_pos = max(len(buffer) - 1, read_pos)
+                    break
+                if len(buffer) < start_idx + RAW_SIZE:
+                    read_pos = start_idx
                     break
-                if len(buffer) < start_idx + RAW_SIZE: break
 
-                potential_packet = buffer[start_idx : start_idx + RAW_SIZE]
-                if potential_packet.endswith(end_marker):
+                if buffer.startswith(RAW_END_BYTES, start_idx + RAW_SIZE - 2):
                     packet_counter += 1
                     if streaming_enabled and (packet_counter % DOWNSAMPLE_RATIO == 0):
-                        eeg_data = potential_packet[10:34]
-                        out_pkt = bytearray([OBCI_START_BYTE])
-                        out_pkt.append(sample_index)
-                        out_pkt.extend(eeg_data)
-                        out_pkt.extend([0]*6)
-                        out_pkt.append(OBCI_END_BYTE)
-                        os.write(master_fd, out_pkt)
+                        frame = n_pending * OBCI_PACKET_SIZE
+                        out_frames[frame + 1] = sample_index
+                        out_frames[frame + OBCI_IDX_EEG : frame + OBCI_IDX_EEG + EEG_DATA_SIZE] = memoryview(buffer)[start_idx + RAW_IDX_EEG : start_idx + RAW_IDX_EEG + EEG_DATA_SIZE]
                         sample_index = (sample_index + 1) % 256
-                    buffer = buffer[start_idx + RAW_SIZE:]
+                        if n_pending == 0: first_pending_time = time.monotonic()
+                        n_pending += 1
+                        if n_pending == OBCI_BATCH_FRAMES:
+                            os.write(master_fd, out_frames)
+                            n_pending = 0
+                    read_pos = start_idx + RAW_SIZE
                     continue
-                buffer = buffer[start_idx + 1:]
+                read_pos = start_idx + 1
+
+            if n_pending and time.monotonic() - first_pending_time >= OBCI_FLUSH_INTERVAL:
+                os.write(master_fd, memoryview(out_frames)[: n_pending * OBCI_PACKET_SIZE])
+                n_pending = 0
+
+            if read_pos > BUFFER_COMPACT_SIZE:
+                del buffer[:read_pos]
+                read_pos = 0
     except KeyboardInterrupt:
         print("Stopping...")
     finally:
+        sel.close()
         ser.close()
         os.close(master_fd)
         os.close(slave_fd)
@@ -5,15 +5,37 @@ import time
 import json
 import socket
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import orjson
+    json_dumps = orjson.dumps
+except ImportError:
+    # orjson is optional (C serializer, returns bytes); stdlib json works the same, just slower
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 
 # --- Configuration ---
 # The HTTP Port the GUI will "find" us on
 EMULATOR_HTTP_PORT = 3000 
+# JSON lines are batched into one sendall once this many bytes are pending,
+# or once this long has passed since the last send (bounds the added latency)
+TCP_FLUSH_BYTES = 4096
+TCP_FLUSH_INTERVAL = 0.05
 
 INITIAL_BAUD_RATE = 9600
 FINAL_BAUD_RATE = 115200
 FIRMWARE_BAUD_RATE_INDEX = 0x04
+SAMPLING_RATE_HZ = 250.0
+SAMPLE_PERIOD_MS = 1000.0 / SAMPLING_RATE_HZ
+# Sample timestamps are counted off the fixed sample period and re-anchored to
+# the wall clock once per this many samples (and after a gap in the stream)
+TIMESTAMP_REANCHOR_SAMPLES = 250
+# ...without stepping backwards: a lagging count jumps forward to the clock, a
+# leading one (fast board clock) is slewed back by shortening the period over
+# the next window, by at most this fraction of it
+TIMESTAMP_MAX_SLEW = 0.5
 
 # --- Serial/Board Constants ---
 DATA_PACKET_START_MARKER = 0xABCD
@@ -23,21 +45,45 @@ HANDSHAKE_START_MARKER_1 = 0xAA
 HANDSHAKE_END_MARKER_1 = 0xCC
 PACKET_IDX_LENGTH = 2
 PACKET_IDX_CHECKSUM = 34
+DATA_PACKET_START_BYTES = DATA_PACKET_START_MARKER.to_bytes(2, 'big')
+DATA_PACKET_END_BYTES = DATA_PACKET_END_MARKER.to_bytes(2, 'big')
+# start(2) | 0x02, unix time | 0x01, baud index | checksum | end(2)
+HANDSHAKE_STRUCT = struct.Struct('>BBBIBBBBB')
+HANDSHAKE_IDX_CHECKSUM = 9
 ADS1299_NUM_CHANNELS = 8
 ADS1299_NUM_STATUS_BYTES = 3
 ADS1299_BYTES_PER_CHANNEL = 3
+PACKET_IDX_CHANNEL_DATA = 7 + ADS1299_NUM_STATUS_BYTES
+# The whole checksummed payload in one precompiled unpack: the tuple is summed
+# for the checksum and its tail holds the channel bytes (struct has no int24,
+# so the 3-byte words are put back together with bit ops)
+PAYLOAD_STRUCT = struct.Struct(f'>{PACKET_IDX_CHECKSUM - PACKET_IDX_LENGTH}B')
+PAYLOAD_IDX_CHANNEL_DATA = PACKET_IDX_CHANNEL_DATA - PACKET_IDX_LENGTH
+READ_BATCH = max(DATA_PACKET_TOTAL_SIZE, FINAL_BAUD_RATE // 10 // 10) # Up to 100 ms of line rate per read
+READ_TIMEOUT = 0.02 # ...but hand back whatever arrived after 20 ms
+BUFFER_COMPACT_SIZE = 4096 # Drop consumed bytes from the buffer past this size
 BOARD_USB_IDS = [{'vid': 0x1A86, 'pid': 0x7523}]
 BOARD_DESCRIPTIONS = ["USB-SERIAL CH340", "CH340"]
 
 # --- Global State for Threading ---
-streaming_active = False
+# Set by the HTTP handler, the TCP worker blocks on them instead of polling
+streaming_event = threading.Event()   # /stream/start sets, /stream/stop clears
+gui_config_ready = threading.Event()  # set once /tcp has told us where to connect
 gui_tcp_config = {"ip": None, "port": None, "output": "json"}
-data_queue = [] # Shared buffer between Serial and TCP
-queue_lock = threading.Lock()
+# Shared buffer between Serial and TCP. Single append/popleft calls are atomic,
+# and maxlen drops the oldest rows in O(1) to keep the queue small (no lag).
+DATA_QUEUE_MAX_ROWS = 500
+data_queue = collections.deque(maxlen=DATA_QUEUE_MAX_ROWS)
 
 # ==============================================================================
 #  1. SERIAL CONNECTION (Your original, working logic)
 # ==============================================================================
+def build_handshake_packet(unix_time):
+    """Handshake that sets the board clock and switches it to FINAL_BAUD_RATE."""
+    packet = bytearray(HANDSHAKE_STRUCT.pack(HANDSHAKE_START_MARKER_1, 0xBB, 0x02, unix_time, 0x01, FIRMWARE_BAUD_RATE_INDEX, 0, HANDSHAKE_END_MARKER_1, 0xDD))
+    packet[HANDSHAKE_IDX_CHECKSUM] = sum(packet[2:HANDSHAKE_IDX_CHECKSUM]) & 0xFF
+    return packet
+
 def find_and_open_board():
     print("Searching for Cerelog Board...")
     ports = serial.tools.list_ports.comports()
@@ -54,13 +100,10 @@ def find_and_open_board():
         try:
             ser = serial.Serial(port_name, INITIAL_BAUD_RATE, timeout=2)
             time.sleep(3) # Wait for reset
-            if ser.in_waiting > 0: ser.read(ser.in_waiting)
+            ser.reset_input_buffer()
 
             print("Sending handshake...")
-            current_unix_time = int(time.time())
-            checksum_payload = struct.pack('>BI', 0x02, current_unix_time) + bytes([0x01, FIRMWARE_BAUD_RATE_INDEX])
-            checksum = sum(checksum_payload) & 0xFF
-            handshake_packet = struct.pack('>BB', HANDSHAKE_START_MARKER_1, 0xBB) + checksum_payload + struct.pack('>B', checksum) + struct.pack('>BB', HANDSHAKE_END_MARKER_1, 0xDD)
+            handshake_packet = build_handshake_packet(int(time.time()))
             
             ser.write(handshake_packet)
             time.sleep(0.1)
@@ -69,7 +112,7 @@ def find_and_open_board():
             ser.reset_input_buffer()
 
             bytes_received = ser.read(DATA_PACKET_TOTAL_SIZE * 5)
-            if bytes_received and DATA_PACKET_START_MARKER.to_bytes(2, 'big') in bytes_received:
+            if bytes_received and DATA_PACKET_START_BYTES in bytes_received:
                 print(f"SUCCESS! Board found on: {port_name}")
                 return ser
             else:
@@ -83,71 +126,88 @@ def find_and_open_board():
 #     Reads USB, parses packets, puts them in the queue
 # ==============================================================================
 def serial_worker(ser):
-    global data_queue
     buffer = bytearray()
-    start_marker = DATA_PACKET_START_MARKER.to_bytes(2, 'big')
-    end_marker = DATA_PACKET_END_MARKER.to_bytes(2, 'big')
+    read_pos = 0
+    next_ms = 0.0
+    period_ms = SAMPLE_PERIOD_MS
+    sample_counter = TIMESTAMP_REANCHOR_SAMPLES
     
+    ser.timeout = READ_TIMEOUT
+    try:
+        # Linux: have the USB-serial driver hand bytes over as they arrive (~16 ms otherwise)
+        ser.set_low_latency_mode(True)
+    except (AttributeError, ValueError):
+        pass
     print("Serial Worker Started.")
     
     while True:
-        if ser.in_waiting > 0:
-            buffer.extend(ser.read(ser.in_waiting))
-        else:
-            time.sleep(0.001)
+        data = ser.read(READ_BATCH)
+        if not data:
+            # Gap in the stream, re-anchor on the next sample
+            sample_counter = TIMESTAMP_REANCHOR_SAMPLES
+            continue
+        buffer.extend(data)
 
         while True:
-            start_idx = buffer.find(start_marker)
+            # Scan forward from read_pos instead of slicing consumed bytes off
+            start_idx = buffer.find(DATA_PACKET_START_BYTES, read_pos)
             if start_idx == -1:
-                if len(buffer) > 0: buffer = buffer[-1:]
+                read_pos = max(len(buffer) - 1, read_pos)
                 break
             if len(buffer) < start_idx + DATA_PACKET_TOTAL_SIZE:
+                read_pos = start_idx
                 break
 
-            potential_packet = buffer[start_idx : start_idx + DATA_PACKET_TOTAL_SIZE]
-            if potential_packet.endswith(end_marker):
-                payload = potential_packet[PACKET_IDX_LENGTH:PACKET_IDX_CHECKSUM]
-                if (sum(payload) & 0xFF) == potential_packet[PACKET_IDX_CHECKSUM]:
+            if buffer.startswith(DATA_PACKET_END_BYTES, start_idx + DATA_PACKET_TOTAL_SIZE - 2):
+                payload = PAYLOAD_STRUCT.unpack_from(buffer, start_idx + PACKET_IDX_LENGTH)
+                if (sum(payload) & 0xFF) == buffer[start_idx + PACKET_IDX_CHECKSUM]:
                     
                     # --- Parse Valid Packet ---
-                    ads_data = potential_packet[7:34]
                     row_data = []
-                    for ch in range(ADS1299_NUM_CHANNELS):
-                        idx = ADS1299_NUM_STATUS_BYTES + ch * ADS1299_BYTES_PER_CHANNEL
-                        raw_bytes = ads_data[idx : idx + ADS1299_BYTES_PER_CHANNEL]
-                        # OpenBCI WiFi JSON expects Raw Integers
-                        val = int.from_bytes(raw_bytes, byteorder='big', signed=True)
+                    for idx in range(PAYLOAD_IDX_CHANNEL_DATA, len(payload), ADS1299_BYTES_PER_CHANNEL):
+                        # OpenBCI WiFi JSON expects Raw Integers (signed 24-bit)
+                        val = (payload[idx] << 16) | (payload[idx + 1] << 8) | payload[idx + 2]
+                        if val & 0x800000: val -= 0x1000000
                         row_data.append(val)
 
                     # Add Aux (0,0,0) and Timestamp
                     row_data.extend([0, 0, 0])
-                    row_data.append(time.time() * 1000)
+                    if sample_counter >= TIMESTAMP_REANCHOR_SAMPLES:
+                        # The sample arrived at most one read ago
+                        now_ms = time.time() * 1000
+                        next_ms = max(next_ms, now_ms - READ_TIMEOUT * 1000)
+                        lead_ms = max(next_ms - now_ms, 0.0)
+                        period_ms = SAMPLE_PERIOD_MS - min(lead_ms / TIMESTAMP_REANCHOR_SAMPLES, TIMESTAMP_MAX_SLEW * SAMPLE_PERIOD_MS)
+                        sample_counter = 0
+                    row_data.append(int(next_ms))
+                    next_ms += period_ms
+                    sample_counter += 1
 
                     # Add to Shared Queue
-                    with queue_lock:
-                        data_queue.append(row_data)
-                        # Keep queue small to prevent lag
-                        if len(data_queue) > 500: data_queue.pop(0)
+                    data_queue.append(row_data)
 
-                    buffer = buffer[start_idx + DATA_PACKET_TOTAL_SIZE:]
+                    read_pos = start_idx + DATA_PACKET_TOTAL_SIZE
                     continue
             
-            buffer = buffer[start_idx + 1:]
+            read_pos = start_idx + 1
+
+        if read_pos > BUFFER_COMPACT_SIZE:
+            del buffer[:read_pos]
+            read_pos = 0
 
 # ==============================================================================
 #  3. TCP STREAMER THREAD
 #     Connects to GUI's TCP Server and pushes data
 # ==============================================================================
 def tcp_worker():
-    global streaming_active, gui_tcp_config, data_queue
+    global gui_tcp_config
     
     print("TCP Worker waiting for config...")
     
     while True:
-        # Wait until GUI sends /stream/start
-        if not streaming_active or not gui_tcp_config["ip"]:
-            time.sleep(0.1)
-            continue
+        # Wait until GUI sends /tcp and /stream/start
+        gui_config_ready.wait()
+        streaming_event.wait()
             
         try:
             print(f"Connecting TCP to GUI at {gui_tcp_config['ip']}:{gui_tcp_config['port']}...")
@@ -156,19 +216,13 @@ def tcp_worker():
             s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             
             packet_count = 0
-            chunk_buffer = []
+            out_buf = bytearray()
+            last_flush = time.monotonic()
 
-            while streaming_active:
-                # Get data from queue
-                with queue_lock:
-                    if len(data_queue) > 0:
-                        chunk_buffer.extend(data_queue)
-                        data_queue.clear()
-                
+            while streaming_event.is_set():
                 # If we have data, send it in chunks of ~10 samples
-                if len(chunk_buffer) >= 10:
-                    send_chunk = chunk_buffer[:10]
-                    chunk_buffer = chunk_buffer[10:]
+                if len(data_queue) >= 10:
+                    send_chunk = [data_queue.popleft() for _ in range(10)]
                     packet_count += 1
                     
                     msg = {
@@ -177,14 +231,19 @@ def tcp_worker():
                     }
                     
                     # OpenBCI GUI expects newline-delimited JSON
-                    json_str = json.dumps(msg) + "\r\n"
-                    s.sendall(json_str.encode('utf-8'))
+                    out_buf += json_dumps(msg)
+                    out_buf += b"\r\n"
                 else:
                     time.sleep(0.005) # Don't burn CPU
+
+                if out_buf and (len(out_buf) >= TCP_FLUSH_BYTES or time.monotonic() - last_flush >= TCP_FLUSH_INTERVAL):
+                    s.sendall(out_buf)
+                    out_buf.clear()
+                    last_flush = time.monotonic()
                     
         except Exception as e:
             print(f"TCP Stream Error: {e}")
-            streaming_active = False # Stop if connection breaks
+            streaming_event.clear() # Stop if connection breaks
         finally:
             s.close()
             print("TCP Socket Closed.")
@@ -195,8 +254,6 @@ def tcp_worker():
 # ==============================================================================
 class ShieldEmulatorHandler(BaseHTTPRequestHandler):
     def do_GET(self):
-        global streaming_active
-        
         if self.path == '/board':
             # GUI asks: "Who are you?"
             print(f"GUI Requested: {self.path} (Handshake)")
@@ -215,14 +272,14 @@ class ShieldEmulatorHandler(BaseHTTPRequestHandler):
         elif self.path == '/stream/start':
             # GUI says: "GO!"
             print("GUI Requested: START STREAMING")
-            streaming_active = True
+            streaming_event.set()
             self.send_response(200)
             self.end_headers()
             
         elif self.path == '/stream/stop':
             # GUI says: "STOP!"
             print("GUI Requested: STOP STREAMING")
-            streaming_active = False
+            streaming_event.clear()
             self.send_response(200)
             self.end_headers()
             
@@ -244,6 +301,8 @@ class ShieldEmulatorHandler(BaseHTTPRequestHandler):
             gui_tcp_config["ip"] = config.get("ip")
             gui_tcp_config["port"] = config.get("port")
             gui_tcp_config["output"] = config.get("output", "json")
+            if gui_tcp_config["ip"]:
+                gui_config_ready.set()
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -276,7 +335,9 @@ def main():
 
     # 4. Start HTTP Server
     server_address = ('0.0.0.0', EMULATOR_HTTP_PORT)
-    httpd = HTTPServer(server_address, ShieldEmulatorHandler)
+    # One thread per request so a slow GUI request can't hold up /stream/start
+    # (HTTPServer already sets SO_REUSEADDR, so a restart rebinds straight away)
+    httpd = ThreadingHTTPServer(server_address, ShieldEmulatorHandler)
     
     print(f"\n>>> WIFI EMULATOR RUNNING on PORT {EMULATOR_HTTP_PORT} <<<")
     print(f"1. Open Standard OpenBCI GUI")
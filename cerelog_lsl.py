@@ -2,8 +2,11 @@ import serial
 import serial.tools.list_ports
 import struct
 import time
+import queue
+import threading
 import numpy as np
 from pylsl import StreamInfo, StreamOutlet, local_clock
+from cerelog_parser import parse_packets, DATA_PACKET_TOTAL_SIZE, DATA_PACKET_START_BYTES, ADS1299_NUM_CHANNELS
 
 # --- Configuration ---
 INITIAL_BAUD_RATE = 9600
@@ -11,6 +14,19 @@ FINAL_BAUD_RATE = 115200
 FIRMWARE_BAUD_RATE_INDEX = 0x04
 SAMPLING_RATE_HZ = 250.0 
 SAMPLE_PERIOD = 1.0 / SAMPLING_RATE_HZ
+LSL_CHUNK_SIZE = 25 # Samples per push_chunk (25 = 100 ms at 250 Hz)
+LSL_CHUNK_POOL_SIZE = 8 # Chunks in flight between the serial and LSL threads
+# Timestamps are counted off the fixed sample period and only checked against
+# the host clock once per this many samples (and after a gap in the stream)
+TIMESTAMP_REANCHOR_SAMPLES = 250
+# A schedule that runs ahead of the host clock (fast board clock) is slewed back
+# by shortening the period over the next window, by at most this fraction of it
+TIMESTAMP_MAX_SLEW = 0.5
+# LSL sample format:
+#   'float32' - DC blocked microvolts scaled for the GUI (what the forked OpenBCI GUI expects)
+#   'int32'   - raw signed 24-bit ADC counts, no conversion or filtering; consumers
+#               multiply by UV_SCALE (also written to the stream metadata as uv_per_count)
+LSL_CHANNEL_FORMAT = 'float32'
 
 # --- PHYSICS CONSTANTS ---
 # We return to the settings that worked in your Plotter Script
@@ -24,35 +40,43 @@ HARDWARE_GAIN = 24
 GUI_CORRECTION_FACTOR = 24.0 * 0.6133
 
 # --- Packet Constants ---
-DATA_PACKET_START_MARKER = 0xABCD
-DATA_PACKET_END_MARKER = 0xDCBA
-DATA_PACKET_TOTAL_SIZE = 37
+# Data packet layout lives in cerelog_parser
 HANDSHAKE_START_MARKER_1 = 0xAA
 HANDSHAKE_END_MARKER_1 = 0xCC
-PACKET_IDX_LENGTH = 2
-PACKET_IDX_CHECKSUM = 34
+# start(2) | 0x02, unix time | 0x01, baud index | checksum | end(2)
+HANDSHAKE_STRUCT = struct.Struct('>BBBIBBBBB')
+HANDSHAKE_IDX_CHECKSUM = 9
 
-# --- ADS1299 Constants ---
-ADS1299_NUM_CHANNELS = 8
-ADS1299_NUM_STATUS_BYTES = 3
-ADS1299_BYTES_PER_CHANNEL = 3
+# --- Serial Read Sizing ---
+# The link rate is fixed, so reads are sized off it instead of asking the
+# driver how much is waiting: ask for up to 100 ms of line rate (10 bits per
+# byte) and let the timeout hand back whatever arrived, ~5 packets at 250 Hz.
+READ_BATCH = max(DATA_PACKET_TOTAL_SIZE, FINAL_BAUD_RATE // 10 // 10)
+READ_TIMEOUT = 0.02
+# Consumed bytes are only dropped from the front of the buffer past this size
+BUFFER_COMPACT_SIZE = 4096
+# Room for a full compaction window, one partial packet and one read
+BUFFER_CAPACITY = BUFFER_COMPACT_SIZE + DATA_PACKET_TOTAL_SIZE + READ_BATCH
 
 # --- Port Detection ---
 BOARD_USB_IDS = [{'vid': 0x1A86, 'pid': 0x7523}]
 BOARD_DESCRIPTIONS = ["USB-SERIAL CH340", "CH340"]
 
-def convert_to_microvolts(raw_val):
-    """
-    1. Calculate uV using REAL hardware physics (Vref 4.5, Gain 24).
-       This preserves the best float resolution for small signals.
-    2. Apply the Correction Factor so the GUI displays the right amplitude.
-    """
-    # Standard ADS1299 conversion (Matches your Plotter)
-    scale_factor = (2 * HARDWARE_VREF / HARDWARE_GAIN) / (2**24)
-    outputV = raw_val * scale_factor * 1000000
-    
-    # Scale up for the GUI
-    return outputV * GUI_CORRECTION_FACTOR
+# --- MICROVOLT CONVERSION ---
+# 1. Calculate uV using REAL hardware physics (Vref 4.5, Gain 24).
+#    This preserves the best float resolution for small signals.
+#    Standard ADS1299 conversion (Matches your Plotter).
+# 2. Apply the Correction Factor so the GUI displays the right amplitude.
+# Both are folded into one scalar at load time, so converting a block of
+# samples is a single multiply.
+UV_SCALE = (2 * HARDWARE_VREF / HARDWARE_GAIN) / (2**24) * 1000000
+GUI_UV_SCALE = UV_SCALE * GUI_CORRECTION_FACTOR
+
+def build_handshake_packet(unix_time):
+    """Handshake that sets the board clock and switches it to FINAL_BAUD_RATE."""
+    packet = bytearray(HANDSHAKE_STRUCT.pack(HANDSHAKE_START_MARKER_1, 0xBB, 0x02, unix_time, 0x01, FIRMWARE_BAUD_RATE_INDEX, 0, HANDSHAKE_END_MARKER_1, 0xDD))
+    packet[HANDSHAKE_IDX_CHECKSUM] = sum(packet[2:HANDSHAKE_IDX_CHECKSUM]) & 0xFF
+    return packet
 
 def find_and_open_board():
     print("Searching for Cerelog Board...")
@@ -66,13 +90,10 @@ def find_and_open_board():
         try:
             ser = serial.Serial(port_name, INITIAL_BAUD_RATE, timeout=2)
             time.sleep(5)
-            if ser.in_waiting > 0: ser.read(ser.in_waiting)
+            ser.reset_input_buffer()
 
             print(f"Sending handshake...")
-            current_unix_time = int(time.time())
-            checksum_payload = struct.pack('>BI', 0x02, current_unix_time) + bytes([0x01, FIRMWARE_BAUD_RATE_INDEX])
-            checksum = sum(checksum_payload) & 0xFF
-            handshake_packet = struct.pack('>BB', HANDSHAKE_START_MARKER_1, 0xBB) + checksum_payload + struct.pack('>B', checksum) + struct.pack('>BB', HANDSHAKE_END_MARKER_1, 0xDD)
+            handshake_packet = build_handshake_packet(int(time.time()))
             ser.write(handshake_packet)
             time.sleep(0.1) 
             ser.baudrate = FINAL_BAUD_RATE
@@ -81,7 +102,7 @@ def find_and_open_board():
             ser.reset_input_buffer()
 
             bytes_received = ser.read(DATA_PACKET_TOTAL_SIZE * 5)
-            if bytes_received and DATA_PACKET_START_MARKER.to_bytes(2, 'big') in bytes_received:
+            if bytes_received and DATA_PACKET_START_BYTES in bytes_received:
                 print(f"SUCCESS on: {port_name}")
                 return ser
             else:
@@ -90,96 +111,166 @@ def find_and_open_board():
             if ser: ser.close()
     return None
 
+def lsl_pusher(outlet, ready_chunks, free_chunks):
+    """
+    Consumer thread: pushes finished chunks to LSL so the network side never
+    holds up draining the serial port, then hands the arrays back to the pool.
+    Stops on a None chunk. If a push fails the error is handed back through
+    the pool, so the serial thread raises it instead of waiting forever.
+    """
+    try:
+        while True:
+            item = ready_chunks.get()
+            if item is None:
+                return
+            chunk, timestamps = item
+            # Anti-Jitter Wait (never push a sample ahead of its timestamp).
+            # Sleep rather than spin, so the serial thread keeps the GIL meanwhile.
+            delay = timestamps[-1] - local_clock()
+            if delay > 0:
+                time.sleep(delay)
+            outlet.push_chunk(chunk, timestamps)
+            free_chunks.put((chunk, timestamps))
+    except Exception as e:
+        free_chunks.put(e)
+
 def main():
     print("Creating LSL Stream Outlet...")
-    info = StreamInfo('Cerelog_EEG', 'EEG', ADS1299_NUM_CHANNELS, SAMPLING_RATE_HZ, 'float32', 'cerelog_uid_1234')
+    raw_mode = LSL_CHANNEL_FORMAT == 'int32'
+    info = StreamInfo('Cerelog_EEG', 'EEG', ADS1299_NUM_CHANNELS, SAMPLING_RATE_HZ, LSL_CHANNEL_FORMAT, 'cerelog_uid_1234')
+    if raw_mode:
+        info.desc().append_child_value('uv_per_count', f"{UV_SCALE:.12g}")
     outlet = StreamOutlet(info)
 
     ser = find_and_open_board()
     if not ser: return
+    ser.timeout = READ_TIMEOUT
+    try:
+        # Linux: have the USB-serial driver hand bytes over as they arrive (~16 ms otherwise)
+        ser.set_low_latency_mode(True)
+    except (AttributeError, ValueError):
+        pass
 
     # --- DC BLOCKER VARIABLES ---
     # We use a filter: y[n] = x[n] - x[n-1] + R * y[n-1]
     # R = 0.995 is a standard coefficient for removing DC while keeping brainwaves.
     R = 0.995
-    prev_x = [0.0] * ADS1299_NUM_CHANNELS
-    prev_y = [0.0] * ADS1299_NUM_CHANNELS
+    prev_x = np.zeros(ADS1299_NUM_CHANNELS)
+    prev_y = np.zeros(ADS1299_NUM_CHANNELS)
     first_sample = True
 
-    buffer = bytearray()
-    start_marker = DATA_PACKET_START_MARKER.to_bytes(2, 'big')
-    end_marker = DATA_PACKET_END_MARKER.to_bytes(2, 'big')
+    # --- LSL CHUNK POOL ---
+    # Chunks are allocated once and cycle between this (serial) thread, which
+    # fills them, and the lsl_pusher thread, which pushes them and returns them.
+    free_chunks = queue.SimpleQueue()
+    ready_chunks = queue.SimpleQueue()
+    for _ in range(LSL_CHUNK_POOL_SIZE):
+        free_chunks.put((np.empty((LSL_CHUNK_SIZE, ADS1299_NUM_CHANNELS), dtype=np.int32 if raw_mode else np.float32), np.empty(LSL_CHUNK_SIZE)))
+    chunk, timestamps = free_chunks.get()
+    cursor = 0
+    pusher = threading.Thread(target=lsl_pusher, args=(outlet, ready_chunks, free_chunks), daemon=True)
+    pusher.start()
+
+    # --- RAW BYTE BUFFER ---
+    # Preallocated uint8 buffer; parse_packets scans it from read_pos and
+    # decodes every complete packet into raw_counts in one compiled pass.
+    buffer = np.empty(BUFFER_CAPACITY, dtype=np.uint8)
+    fill = 0
+    read_pos = 0
+    raw_counts = np.empty((READ_BATCH // DATA_PACKET_TOTAL_SIZE + 1, ADS1299_NUM_CHANNELS), dtype=np.int32)
     
     # --- PRECISION TIMING ---
     next_schedule = local_clock()
+    sample_period = SAMPLE_PERIOD
+    samples_since_anchor = 0
 
-    print("\n>>> STREAMING WITH ACTIVE DC BLOCKER >>>")
-    print(f"Hardware Gain: {HARDWARE_GAIN} | GUI Cal: {GUI_CORRECTION_FACTOR:.2f}")
+    if raw_mode:
+        print("\n>>> STREAMING RAW ADC COUNTS (int32) >>>")
+        print(f"Hardware Gain: {HARDWARE_GAIN} | uV per count: {UV_SCALE:.6g}")
+    else:
+        print("\n>>> STREAMING WITH ACTIVE DC BLOCKER >>>")
+        print(f"Hardware Gain: {HARDWARE_GAIN} | GUI Cal: {GUI_CORRECTION_FACTOR:.2f}")
     
     try:
         while True:
-            if ser.in_waiting > 0:
-                buffer.extend(ser.read(ser.in_waiting))
-            else:
-                if len(buffer) < DATA_PACKET_TOTAL_SIZE:
-                    time.sleep(0.001) 
-                    continue
+            data = ser.read(READ_BATCH)
+            if not data:
+                # Gap in the stream, re-anchor on the next sample
+                samples_since_anchor = TIMESTAMP_REANCHOR_SAMPLES
+                continue
+            buffer[fill : fill + len(data)] = np.frombuffer(data, dtype=np.uint8)
+            fill += len(data)
 
             while True:
-                start_idx = buffer.find(start_marker)
-                if start_idx == -1:
-                    break
-                if len(buffer) < start_idx + DATA_PACKET_TOTAL_SIZE:
-                    break
+                read_pos, n_out = parse_packets(buffer[:fill], read_pos, raw_counts)
+
+                if raw_mode:
+                    # Raw Ints go out as they are
+                    block = raw_counts[:n_out]
+                else:
+                    # Parse Raw Ints and convert to uV (High Precision, Scaled for GUI)
+                    block = raw_counts[:n_out] * GUI_UV_SCALE
+
+                for sample in block:
+                    if not raw_mode:
+                        # --- IIR DC BLOCKER FILTER ---
+                        # This replaces the static offset. It tracks drift continuously.
+                        current_x = sample
+                        if first_sample:
+                            current_y = np.zeros(ADS1299_NUM_CHANNELS) # Start at zero
+                        else:
+                            # y[n] = x[n] - x[n-1] + R * y[n-1]
+                            current_y = current_x - prev_x + (R * prev_y)
+
+                        # Update history
+                        prev_x = current_x
+                        prev_y = current_y
 
-                potential_packet = buffer[start_idx : start_idx + DATA_PACKET_TOTAL_SIZE]
-                
-                if potential_packet.endswith(end_marker):
-                    payload = potential_packet[PACKET_IDX_LENGTH:PACKET_IDX_CHECKSUM]
-                    if (sum(payload) & 0xFF) == potential_packet[PACKET_IDX_CHECKSUM]:
-                        
-                        # Anti-Jitter Wait
-                        while local_clock() < next_schedule:
-                            pass 
-
-                        ads_data = potential_packet[7:34] 
-                        lsl_sample = []
-                        
-                        for ch in range(ADS1299_NUM_CHANNELS):
-                            idx = ADS1299_NUM_STATUS_BYTES + ch * ADS1299_BYTES_PER_CHANNEL
-                            # Parse Raw Int
-                            raw_val = int.from_bytes(ads_data[idx : idx + ADS1299_BYTES_PER_CHANNEL], byteorder='big', signed=True)
-                            
-                            # Convert to uV (High Precision, Scaled for GUI)
-                            current_x = convert_to_microvolts(raw_val)
-                            
-                            # --- IIR DC BLOCKER FILTER ---
-                            # This replaces the static offset. It tracks drift continuously.
-                            if first_sample:
-                                current_y = 0.0 # Start at zero
-                            else:
-                                # y[n] = x[n] - x[n-1] + R * y[n-1]
-                                current_y = current_x - prev_x[ch] + (R * prev_y[ch])
-                            
-                            # Update history
-                            prev_x[ch] = current_x
-                            prev_y[ch] = current_y
-                            
-                            lsl_sample.append(current_y)
-                        
                         first_sample = False
-                        outlet.push_sample(lsl_sample, next_schedule)
-                        next_schedule += SAMPLE_PERIOD
-                        
-                        buffer = buffer[start_idx + DATA_PACKET_TOTAL_SIZE:]
-                        continue
-                
-                buffer = buffer[start_idx + 1:]
+                        sample = current_y
+
+                    if samples_since_anchor >= TIMESTAMP_REANCHOR_SAMPLES:
+                        # Don't let the schedule fall behind the host clock (the sample
+                        # arrived at most one read ago); never step it backwards.
+                        now = local_clock()
+                        next_schedule = max(next_schedule, now - READ_TIMEOUT)
+                        # Nor run ahead of it, or the pusher's wait would keep growing
+                        lead = max(next_schedule - now, 0.0)
+                        sample_period = SAMPLE_PERIOD - min(lead / TIMESTAMP_REANCHOR_SAMPLES, TIMESTAMP_MAX_SLEW * SAMPLE_PERIOD)
+                        samples_since_anchor = 0
+                    samples_since_anchor += 1
+
+                    chunk[cursor] = sample
+                    timestamps[cursor] = next_schedule
+                    next_schedule += sample_period
+                    cursor += 1
+
+                    if cursor == LSL_CHUNK_SIZE:
+                        ready_chunks.put((chunk, timestamps))
+                        cursor = 0
+                        free = free_chunks.get()
+                        if isinstance(free, Exception):
+                            raise free
+                        chunk, timestamps = free
+
+                # A full raw_counts means there may be more packets waiting
+                if n_out < len(raw_counts):
+                    break
+
+            if read_pos > BUFFER_COMPACT_SIZE:
+                buffer[: fill - read_pos] = buffer[read_pos:fill]
+                fill -= read_pos
+                read_pos = 0
 
     except KeyboardInterrupt:
         print("\nStopping Stream...")
     finally:
         if ser: ser.close()
+        # Let the pusher send the queued chunks and the partial one before exiting
+        if cursor:
+            ready_chunks.put((chunk[:cursor], timestamps[:cursor]))
+        ready_chunks.put(None)
+        pusher.join()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,104 @@
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# --- Packet Layout ---
+# [0xAB 0xCD] [len .. timestamp] [3 status bytes] [8 x 3 channel bytes] [checksum] [0xDC 0xBA]
+DATA_PACKET_TOTAL_SIZE = 37
+START_MARKER_HI = 0xAB
+START_MARKER_LO = 0xCD
+END_MARKER_HI = 0xDC
+END_MARKER_LO = 0xBA
+DATA_PACKET_START_BYTES = bytes([START_MARKER_HI, START_MARKER_LO])
+DATA_PACKET_END_BYTES = bytes([END_MARKER_HI, END_MARKER_LO])
+PACKET_IDX_LENGTH = 2
+PACKET_IDX_CHANNEL_DATA = 10
+PACKET_IDX_CHECKSUM = 34
+ADS1299_NUM_CHANNELS = 8
+ADS1299_BYTES_PER_CHANNEL = 3
+# Byte offsets of the 24 channel bytes within a packet
+CHANNEL_BYTE_OFFSETS = np.arange(PACKET_IDX_CHANNEL_DATA, PACKET_IDX_CHANNEL_DATA + ADS1299_NUM_CHANNELS * ADS1299_BYTES_PER_CHANNEL)
+
+def _scan_packets(buf, read_pos, out):
+    """
+    Scan buf (uint8 array) from read_pos for complete packets with a valid
+    end marker and checksum, and write their 8 signed 24-bit channel values
+    into consecutive rows of out (int32 array, shape (N, 8)).
+
+    Framing, checksum and channel decode are done in a single compiled pass.
+    Returns (new_read_pos, n_out). Stops early once out is full, so call
+    again while n_out == len(out).
+    """
+    n = buf.shape[0]
+    n_out = 0
+    i = read_pos
+    while i + 1 < n and n_out < out.shape[0]:
+        if buf[i] != START_MARKER_HI or buf[i + 1] != START_MARKER_LO:
+            i += 1
+            continue
+        if i + DATA_PACKET_TOTAL_SIZE > n:
+            # Incomplete packet, wait for more bytes
+            return i, n_out
+        if buf[i + DATA_PACKET_TOTAL_SIZE - 2] != END_MARKER_HI or buf[i + DATA_PACKET_TOTAL_SIZE - 1] != END_MARKER_LO:
+            i += 1
+            continue
+
+        checksum = 0
+        for j in range(i + PACKET_IDX_LENGTH, i + PACKET_IDX_CHECKSUM):
+            checksum += int(buf[j])
+        if (checksum & 0xFF) != buf[i + PACKET_IDX_CHECKSUM]:
+            i += 1
+            continue
+
+        for ch in range(ADS1299_NUM_CHANNELS):
+            k = i + PACKET_IDX_CHANNEL_DATA + ch * ADS1299_BYTES_PER_CHANNEL
+            val = (int(buf[k]) << 16) | (int(buf[k + 1]) << 8) | int(buf[k + 2])
+            if val & 0x800000:
+                val -= 0x1000000
+            out[n_out, ch] = val
+        n_out += 1
+        i += DATA_PACKET_TOTAL_SIZE
+    return i, n_out
+
+def _find_packets(buf, read_pos, out):
+    """
+    Same contract as _scan_packets, for when numba is missing: element-wise
+    loops over a numpy array are slow in plain Python, so packets are framed
+    on a bytes copy with find() and slicing, and the channels of all of them
+    are decoded together at the end.
+    """
+    data = buf.tobytes()
+    n = len(data)
+    starts = []
+    i = read_pos
+    while len(starts) < len(out):
+        start_idx = data.find(DATA_PACKET_START_BYTES, i)
+        if start_idx == -1:
+            i = max(n - 1, i)
+            break
+        i = start_idx
+        if i + DATA_PACKET_TOTAL_SIZE > n:
+            # Incomplete packet, wait for more bytes
+            break
+        if not data.startswith(DATA_PACKET_END_BYTES, i + DATA_PACKET_TOTAL_SIZE - 2):
+            i += 1
+            continue
+        if (sum(data[i + PACKET_IDX_LENGTH : i + PACKET_IDX_CHECKSUM]) & 0xFF) != data[i + PACKET_IDX_CHECKSUM]:
+            i += 1
+            continue
+
+        starts.append(i)
+        i += DATA_PACKET_TOTAL_SIZE
+
+    n_out = len(starts)
+    if n_out:
+        raw = buf[np.add.outer(starts, CHANNEL_BYTE_OFFSETS)].astype(np.int32).reshape(n_out, ADS1299_NUM_CHANNELS, ADS1299_BYTES_PER_CHANNEL)
+        vals = (raw[:, :, 0] << 16) | (raw[:, :, 1] << 8) | raw[:, :, 2]
+        out[:n_out] = vals - ((vals & 0x800000) << 1)
+    return i, n_out
+
+# Compiled when numba is installed, otherwise the bytes/find version
+parse_packets = njit(cache=True)(_scan_packets) if njit else _find_packets